@@ -1,9 +1,16 @@
 import os
+import re
+import asyncio
+import time
 import logging
-import json
+from typing import Optional, Dict, List
+from cachetools import TTLCache
+from pydantic import ValidationError
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+from models import AIVerdict
+
 load_dotenv()
 
 logger = logging.getLogger(__name__)
@@ -15,53 +22,80 @@ if GEMINI_API_KEY:
 else:
     logger.warning("GEMINI_API_KEY not found. AI Judge will default to BLOCK.")
 
-async def judge_command(command_text: str) -> dict:
-    """
-    Layer 3: AI Contextual Analysis
-    Uses Gemini to decide if a command is safe.
-    Returns: {'status': 'EXECUTED'|'BLOCKED', 'reason': '...'}
-    """
-    if not GEMINI_API_KEY:
-        return {
-            "status": "BLOCKED", 
-            "reason": "AI Judge unavailable (Missing API Key)"
-        }
-        
+# Use gemini-2.5-flash (current stable model), built once per process
+MODEL_NAME = 'gemini-2.5-flash'
+model = genai.GenerativeModel(MODEL_NAME) if GEMINI_API_KEY else None
+
+PROMPT_TEMPLATE = """
+You are a Linux Security Officer. Analyze this command: '{command_text}'. 
+Is it safe to execute on a production server? 
+
+Rules:
+1. harmless commands (ls, pwd, echo, cat) -> SAFE
+2. destructive commands (rm -rf /, mkfs, dd) -> DANGEROUS
+3. system modification (chmod, chown, useradd) -> DANGEROUS unless clearly benign
+4. data exfiltration (curl, wget, nc) -> DANGEROUS if suspicious URL/IP
+
+Reply with valid JSON only: {{"status": "EXECUTED"|"BLOCKED", "reason": "short explanation"}}
+"""
+
+# Verdict cache: repeated commands skip the Gemini round-trip.
+# Both EXECUTED and BLOCKED verdicts are cached; failures are not.
+VERDICT_CACHE_MAXSIZE = 4096
+VERDICT_CACHE_TTL_SECONDS = 3600
+
+_verdict_cache: TTLCache = TTLCache(maxsize=VERDICT_CACHE_MAXSIZE, ttl=VERDICT_CACHE_TTL_SECONDS)
+
+# Per-user cap on cache misses (actual Gemini calls) per minute
+AI_MISS_RATE_LIMIT = int(os.getenv("AI_MISS_RATE_LIMIT", 30))
+
+_miss_counts: TTLCache = TTLCache(maxsize=10_000, ttl=120)
+
+# Collapse runs of spaces/tabs only - newlines separate commands and must stay
+_BLANKS = re.compile(r"[ \t]+")
+
+def _normalize(command_text: str) -> str:
+    return _BLANKS.sub(" ", command_text.strip())
+
+def _over_miss_limit(user_id: str) -> bool:
+    """Count a Gemini call against the user's current one-minute window"""
+    window_key = (user_id, int(time.monotonic() // 60))
+    count = _miss_counts.get(window_key, 0) + 1
+    _miss_counts[window_key] = count
+    return count > AI_MISS_RATE_LIMIT
+
+# Bounded fan-out: judge calls are queued and served by AI_WORKERS tasks,
+# so at most AI_WORKERS Gemini requests are in flight per process.
+AI_WORKERS = int(os.getenv("AI_WORKERS", (os.cpu_count() or 1) * 5))
+AI_QUEUE_MAXSIZE = int(os.getenv("AI_QUEUE_MAXSIZE", 1000))
+# How long a request waits for queue space before being blocked as busy
+AI_QUEUE_PUT_TIMEOUT_SECONDS = 1.0
+
+_queue: Optional[asyncio.Queue] = None
+_workers: List[asyncio.Task] = []
+# Identical commands already waiting on Gemini share one future
+_in_flight: Dict[str, asyncio.Future] = {}
+
+async def _ask_gemini(command_text: str, cache_key: str) -> dict:
+    """One Gemini round-trip; valid verdicts are cached under cache_key"""
     try:
-        # Use gemini-2.5-flash (current stable model)
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        
-        prompt = f"""
-        You are a Linux Security Officer. Analyze this command: '{command_text}'. 
-        Is it safe to execute on a production server? 
-        
-        Rules:
-        1. harmless commands (ls, pwd, echo, cat) -> SAFE
-        2. destructive commands (rm -rf /, mkfs, dd) -> DANGEROUS
-        3. system modification (chmod, chown, useradd) -> DANGEROUS unless clearly benign
-        4. data exfiltration (curl, wget, nc) -> DANGEROUS if suspicious URL/IP
+        prompt = PROMPT_TEMPLATE.format(command_text=command_text)
         
-        Reply with valid JSON only: {{"status": "EXECUTED"|"BLOCKED", "reason": "short explanation"}}
-        """
-        
-        # Use sync API in async wrapper
-        import asyncio
-        response = await asyncio.to_thread(model.generate_content, prompt)
-        response_text = response.text
+        # Native async API - awaited on the event loop, no worker thread
+        response = await model.generate_content_async(prompt)
         
         # Clean up code blocks if present
-        if response_text.startswith("```json"):
-            response_text = response_text[7:]
-        if response_text.endswith("```"):
-            response_text = response_text[:-3]
-            
-        result = json.loads(response_text.strip())
+        response_text = response.text.strip().removeprefix("```json").removesuffix("```")
         
-        # Validate structure
-        if "status" not in result or result["status"] not in ["EXECUTED", "BLOCKED"]:
-            logger.error(f"Invalid AI response format: {result}")
+        # Parse + validate structure in one pass (pydantic-core, no json.loads)
+        try:
+            verdict = AIVerdict.model_validate_json(response_text)
+        except ValidationError as e:
+            logger.error(f"Invalid AI response format: {response_text!r} ({e.error_count()} errors)")
             return {"status": "BLOCKED", "reason": "AI returned invalid format"}
-            
+        
+        result = verdict.model_dump()
+        _verdict_cache[cache_key] = result
         return result
         
     except Exception as e:
@@ -70,3 +104,86 @@ async def judge_command(command_text: str) -> dict:
             "status": "BLOCKED",
             "reason": f"AI Judge failed: {str(e)}"
         }
+
+async def _worker():
+    while True:
+        command_text, cache_key, future = await _queue.get()
+        try:
+            result = await _ask_gemini(command_text, cache_key)
+            if not future.done():
+                future.set_result(result)
+        finally:
+            _queue.task_done()
+
+async def start_workers():
+    """Create the judge queue and its worker pool (call from app startup)"""
+    global _queue
+    if _queue is not None or not GEMINI_API_KEY:
+        return
+    _queue = asyncio.Queue(maxsize=AI_QUEUE_MAXSIZE)
+    _workers.extend(asyncio.create_task(_worker()) for _ in range(AI_WORKERS))
+    logger.info(f"✓ AI Judge workers started ({AI_WORKERS})")
+
+async def stop_workers():
+    """Cancel the worker pool and fail any verdicts still waiting"""
+    global _queue
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    for future in _in_flight.values():
+        future.cancel()
+    _in_flight.clear()
+    _queue = None
+
+async def judge_command(command_text: str, user_id: Optional[str] = None) -> dict:
+    """
+    Layer 3: AI Contextual Analysis
+    Uses Gemini to decide if a command is safe.
+    Returns: {'status': 'EXECUTED'|'BLOCKED', 'reason': '...'}
+    """
+    if not GEMINI_API_KEY:
+        return {
+            "status": "BLOCKED", 
+            "reason": "AI Judge unavailable (Missing API Key)"
+        }
+    
+    cache_key = _normalize(command_text)
+    cached = _verdict_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"AI Judge cache hit: {cached['status']}")
+        return cached
+    
+    # Join an identical in-flight request instead of asking again
+    future = _in_flight.get(cache_key)
+    if future is not None:
+        return await asyncio.shield(future)
+    
+    if user_id is not None and _over_miss_limit(user_id):
+        logger.warning(f"AI Judge rate limit exceeded for user {user_id}")
+        return {
+            "status": "BLOCKED",
+            "reason": "AI Judge rate limit exceeded, try again shortly"
+        }
+    
+    # Workers not running (e.g. outside the app lifespan): call directly
+    if _queue is None:
+        return await _ask_gemini(command_text, cache_key)
+    
+    future = asyncio.get_running_loop().create_future()
+    _in_flight[cache_key] = future
+    future.add_done_callback(lambda _: _in_flight.pop(cache_key, None))
+    busy = {"status": "BLOCKED", "reason": "AI Judge busy, try again shortly"}
+    try:
+        await asyncio.wait_for(_queue.put((command_text, cache_key, future)),
+                               timeout=AI_QUEUE_PUT_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning("AI Judge queue full, blocking command")
+        future.set_result(busy)
+        return busy
+    except asyncio.CancelledError:
+        # Never enqueued: resolve it so joiners don't wait forever
+        future.set_result(busy)
+        raise
+    # Shielded: a disconnecting client must not cancel a shared verdict
+    return await asyncio.shield(future)
@@ -1,21 +1,96 @@
 from fastapi import Security, HTTPException, status
 from fastapi.security import APIKeyHeader
-from database import supabase
-from pydantic import BaseModel
+from database import get_pool, record_to_dict
+from pydantic import BaseModel, ConfigDict
+from cachetools import TTLCache
+from typing import Optional
+import hashlib
+import time
 
 # Define the Header Scheme
 api_key_header = APIKeyHeader(name="x-api-key", auto_error=False)
 
 class UserPayload(BaseModel):
+    # Frozen: cached instances are shared between concurrent requests.
+    # Carries no api_key, so the cache never holds raw keys.
+    model_config = ConfigDict(frozen=True)
+    
     id: str
     name: str
     role: str
     credits: int
-    api_key: str
+
+# In-process cache of resolved API keys -> (UserPayload, loaded_at).
+# Keyed by a BLAKE2b digest so raw keys are never used as cache keys.
+# Re-inserting an entry restarts its TTLCache timer, so loaded_at is what
+# bounds how long a user is served without a DB read.
+USER_CACHE_MAXSIZE = 10_000
+USER_CACHE_TTL_SECONDS = 30
+
+# user id -> digest of that user's cache entry, pruned along with the cache
+_user_keys: dict = {}
+# Bumped by invalidate_user so lookups that raced a mutation don't re-cache
+_generation = 0
+
+def _forget(key_hash: bytes, entry: tuple) -> None:
+    user, _ = entry
+    if _user_keys.get(user.id) == key_hash:
+        del _user_keys[user.id]
+
+class _UserCache(TTLCache):
+    """TTLCache that drops the _user_keys link of every evicted entry"""
+    
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for key_hash, entry in expired:
+            _forget(key_hash, entry)
+        return expired
+    
+    def popitem(self):
+        key_hash, entry = super().popitem()
+        _forget(key_hash, entry)
+        return key_hash, entry
+
+_user_cache: TTLCache = _UserCache(maxsize=USER_CACHE_MAXSIZE, ttl=USER_CACHE_TTL_SECONDS)
+
+def _key_hash(api_key: str) -> bytes:
+    return hashlib.blake2b(api_key.encode(), digest_size=16).digest()
+
+def _store(key_hash: bytes, user: UserPayload, loaded_at: float) -> None:
+    _user_cache[key_hash] = (user, loaded_at)
+    _user_keys[user.id] = key_hash
+
+def _cached(key_hash: bytes) -> Optional[tuple]:
+    entry = _user_cache.get(key_hash)
+    if entry is not None and time.monotonic() - entry[1] < USER_CACHE_TTL_SECONDS:
+        return entry
+    return None
+
+def cache_user(api_key: str, user: UserPayload) -> None:
+    """Insert (or refresh) a user in the API-key cache"""
+    _store(_key_hash(api_key), user, time.monotonic())
+
+def update_cached_credits(user: UserPayload, credits: int) -> None:
+    """Set the cached user's new balance (after a deduction), if still cached"""
+    key_hash = _user_keys.get(user.id)
+    entry = _cached(key_hash) if key_hash is not None else None
+    if entry is not None:
+        # Keep the original load time: the entry still expires on schedule
+        cached, loaded_at = entry
+        _store(key_hash, cached.model_copy(update={"credits": credits}), loaded_at)
+
+def invalidate_user(user_id: str) -> None:
+    """Drop the cached entry belonging to user_id (call after user mutations)"""
+    global _generation
+    _generation += 1
+    key_hash = _user_keys.pop(user_id, None)
+    if key_hash is not None:
+        _user_cache.pop(key_hash, None)
 
 async def get_current_user(api_key: str = Security(api_key_header)):
     """
     Authenticates user by checking the x-api-key header against the DB.
+    Resolved users are served from an in-process TTL cache.
     """
     if not api_key:
         raise HTTPException(
@@ -23,31 +98,45 @@ async def get_current_user(api_key: str = Security(api_key_header)):
             detail="Missing API Key. Use header 'x-api-key'"
         )
 
-    # 1. Direct Lookup
+    # 1. Cache Lookup
+    key_hash = _key_hash(api_key)
+    entry = _cached(key_hash)
+    if entry is not None:
+        return entry[0]
+
+    # 2. Direct Lookup
+    generation = _generation
+    loaded_at = time.monotonic()
     try:
-        response = supabase.table("app_users").select("*").eq("api_key", api_key).execute()
+        row = await get_pool().fetchrow(
+            "SELECT id, name, role, credits FROM app_users WHERE api_key = $1",
+            api_key
+        )
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Database error: {str(e)}"
         )
     
-    # 2. Handle Invalid Key
-    if not response.data or len(response.data) == 0:
+    # 3. Handle Invalid Key
+    if row is None:
         raise HTTPException(
             status_code=401, 
             detail="Invalid API Key"
         )
 
-    user = response.data[0]
+    user = record_to_dict(row)
     
-    return UserPayload(
+    payload = UserPayload(
         id=user['id'],
         name=user['name'],
         role=user['role'],
-        credits=user['credits'],
-        api_key=user['api_key']
+        credits=user['credits']
     )
+    # A user mutated while we were fetching must not be re-cached stale
+    if generation == _generation:
+        _store(key_hash, payload, loaded_at)
+    return payload
 
 async def get_admin_user(user: UserPayload = Security(get_current_user)):
     """Guard for Admin Routes"""
@@ -0,0 +1,114 @@
+import os
+import asyncio
+import logging
+from typing import Optional, List, Tuple
+
+from database import get_pool, LONG_COMMAND_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Audit rows are written off the request path: execute_command enqueues them
+# and one background task flushes them in batches with a single COPY.
+LOG_QUEUE_MAXSIZE = int(os.getenv("LOG_QUEUE_MAXSIZE", 10_000))
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_SECONDS = 0.05
+# How long a request waits for queue space before writing its row itself
+LOG_PUT_TIMEOUT_SECONDS = 0.1
+LOG_DRAIN_TIMEOUT_SECONDS = 10
+
+LOG_COLUMNS = ("user_id", "command_text", "status", "verdict_source", "risk_score")
+
+LogRow = Tuple[str, str, str, Optional[str], int]
+
+_queue: Optional[asyncio.Queue] = None
+_writer: Optional[asyncio.Task] = None
+
+INSERT_SQL = (
+    "INSERT INTO command_logs (user_id, command_text, status, verdict_source, risk_score) "
+    "VALUES ($1, $2, $3, $4, $5)"
+)
+
+async def _write(rows: List[LogRow]):
+    try:
+        await get_pool().copy_records_to_table("command_logs", records=rows, columns=LOG_COLUMNS,
+                                              timeout=LONG_COMMAND_TIMEOUT)
+        return
+    except Exception as e:
+        if len(rows) == 1:
+            logger.error(f"Failed to log command: {e}")
+            return
+        logger.warning(f"Batch log of {len(rows)} commands failed, retrying row by row: {e}")
+    # One bad row (e.g. a user deleted meanwhile) must not lose the batch
+    for row in rows:
+        try:
+            await get_pool().execute(INSERT_SQL, *row)
+        except Exception as e:
+            logger.error(f"Failed to log command: {e}")
+
+async def _drain():
+    while True:
+        batch = [await _queue.get()]
+        # Let a burst accumulate unless a full batch is already waiting
+        if _queue.qsize() < LOG_BATCH_SIZE - 1:
+            await asyncio.sleep(LOG_FLUSH_SECONDS)
+        while len(batch) < LOG_BATCH_SIZE and not _queue.empty():
+            batch.append(_queue.get_nowait())
+        try:
+            await _write(batch)
+        finally:
+            for _ in batch:
+                _queue.task_done()
+
+async def log_command(user_id: str, command_text: str, status: str,
+                      verdict_source: Optional[str], risk_score: int):
+    """Queue one command_logs row; written directly if the writer isn't running"""
+    row = (user_id, command_text, status, verdict_source, risk_score)
+    if _queue is None:
+        await _write([row])
+        return
+    try:
+        _queue.put_nowait(row)
+    except asyncio.QueueFull:
+        try:
+            await asyncio.wait_for(_queue.put(row), timeout=LOG_PUT_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            # Backlogged: never drop an audit row, pay the round-trip instead
+            await _write([row])
+
+async def log_commands(rows: List[LogRow]):
+    """Queue several rows at once; whatever doesn't fit is written with one COPY"""
+    if _queue is None:
+        await _write(rows)
+        return
+    for position, row in enumerate(rows):
+        try:
+            _queue.put_nowait(row)
+        except asyncio.QueueFull:
+            await _write(rows[position:])
+            return
+
+async def start_log_writer():
+    """Create the log queue and its writer task (call from app startup)"""
+    global _queue, _writer
+    if _queue is not None:
+        return
+    _queue = asyncio.Queue(maxsize=LOG_QUEUE_MAXSIZE)
+    _writer = asyncio.create_task(_drain())
+    logger.info("✓ Command log writer started")
+
+async def stop_log_writer():
+    """Flush queued rows, then stop the writer (call before closing the pool)"""
+    global _queue, _writer
+    if _queue is None:
+        return
+    try:
+        await asyncio.wait_for(_queue.join(), timeout=LOG_DRAIN_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning(f"Command log drain timed out, dropping {_queue.qsize()} rows")
+    _writer.cancel()
+    try:
+        await _writer
+    except asyncio.CancelledError:
+        pass
+    _queue = None
+    _writer = None
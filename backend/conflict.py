@@ -1,9 +1,159 @@
 from greenery import parse
+from functools import lru_cache
+from bisect import bisect_right
+from collections import deque
+from itertools import islice
 from typing import List, Tuple, Optional
 import logging
 
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+
 logger = logging.getLogger(__name__)
 
+# Parsing and intersecting are pure functions of the pattern strings, so
+# results are memoized across calls (an existing rule is parsed once per
+# process, not once per admin submission). Bounded by LRU size.
+PARSE_CACHE_SIZE = 1024
+COLLISION_CACHE_SIZE = 4096
+
+# Example generation is a BFS over intersection states; skip it when the
+# product FSM is too large to walk quickly (states x alphabet transitions)
+EXAMPLE_MAX_TRANSITIONS = 200_000
+
+# Candidate characters tried first so examples stay readable
+_EXAMPLE_CHARS = "abcdefghijklmnopqrstuvwxyz0123456789 -/._ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse(pattern_str: str):
+    # Work at FSM level: Pattern & Pattern would convert FSM -> regex and back
+    return parse(pattern_str).to_fsm()
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def literal_prefix(pattern_str: str) -> str:
+    """
+    Literal text every string matched by the pattern must start with.
+    Read off the parse tree, so escapes, character classes and alternation
+    are understood; gives up ('') on patterns it can't parse or that ignore case.
+    """
+    try:
+        parsed = sre_parse.parse(pattern_str)
+    except Exception:
+        return ""
+    if parsed.state.flags & sre_parse.SRE_FLAG_IGNORECASE:
+        return ""
+    
+    items = list(parsed)
+    # A leading '^' is either an anchor or (for greenery) a literal shared by
+    # every anchored rule; skipping it keeps the comparison sound either way
+    if items and items[0] == (sre_parse.AT, sre_parse.AT_BEGINNING):
+        items = items[1:]
+    
+    # Only leading literals count: a repeat, class, group or top-level
+    # alternation (a BRANCH node) ends the prefix. Rules are matched with
+    # `regex`, where a '{' sre reads as text may open a fuzzy constraint
+    # such as {e<=1} on the preceding item, so '{' ends it too and drops
+    # the literal before it
+    prefix = []
+    for op, value in items:
+        if op is not sre_parse.LITERAL:
+            break
+        if value == ord('{'):
+            if prefix:
+                prefix.pop()
+            break
+        prefix.append(chr(value))
+    return "".join(prefix)
+
+def _maybe_overlap(pattern_a: str, pattern_b: str) -> bool:
+    """Cheap pre-check: disjoint literal prefixes can never match the same string"""
+    prefix_a = literal_prefix(pattern_a)
+    prefix_b = literal_prefix(pattern_b)
+    return prefix_a.startswith(prefix_b) or prefix_b.startswith(prefix_a)
+
+class PrefixIndex:
+    """
+    Rules bucketed by literal prefix, so a new pattern is only compared with
+    rules whose prefix is compatible with its own (one a prefix of the
+    other) - the same test _maybe_overlap applies pairwise.
+    """
+    
+    def __init__(self, rules: List[dict]):
+        self.rules = rules
+        # prefix -> positions in rules
+        self._by_prefix = {}
+        for position, rule in enumerate(rules):
+            self._by_prefix.setdefault(literal_prefix(rule['pattern']), []).append(position)
+        self._prefixes = sorted(self._by_prefix)
+    
+    def candidates(self, pattern_str: str) -> List[dict]:
+        """Rules that may overlap pattern_str, in their original order"""
+        prefix = literal_prefix(pattern_str)
+        positions = []
+        # Rules whose prefix is a prefix of ours (including '')
+        for end in range(len(prefix) + 1):
+            positions.extend(self._by_prefix.get(prefix[:end], ()))
+        # Rules whose prefix extends ours sort right after it
+        for existing in islice(self._prefixes, bisect_right(self._prefixes, prefix), None):
+            if not existing.startswith(prefix):
+                break
+            positions.extend(self._by_prefix[existing])
+        return [self.rules[position] for position in sorted(positions)]
+
+def _example_char(charclass) -> Optional[str]:
+    for char in _EXAMPLE_CHARS:
+        if charclass.accepts(char):
+            return char
+    if not charclass.negated:
+        return next(charclass.get_chars(), None)
+    return None
+
+def _shortest_example(fsm) -> Optional[str]:
+    """
+    Shortest string accepted by the FSM, found by BFS over states (each state
+    visited once) with one representative character per transition.
+    Unlike fsm.strings(), this never enumerates every character of a class.
+    """
+    if fsm.initial in fsm.finals:
+        return ""
+    seen = {fsm.initial}
+    queue = deque([(fsm.initial, "")])
+    while queue:
+        state, prefix = queue.popleft()
+        for charclass, next_state in fsm.map.get(state, {}).items():
+            if next_state in seen:
+                continue
+            char = _example_char(charclass)
+            if char is None:
+                continue
+            if next_state in fsm.finals:
+                return prefix + char
+            seen.add(next_state)
+            queue.append((next_state, prefix + char))
+    return None
+
+@lru_cache(maxsize=COLLISION_CACHE_SIZE)
+def _collision(pattern_a: str, pattern_b: str) -> Optional[str]:
+    """
+    Returns an example string matched by BOTH patterns, or None if disjoint.
+    Call with the pair sorted - intersection is symmetric.
+    """
+    # Calculate Intersection (A & B)
+    # This creates a new FSM accepting ONLY strings that match BOTH patterns
+    intersection = _parse(pattern_a) & _parse(pattern_b)
+    
+    # If Intersection is empty, there is no overlap
+    if intersection.empty():
+        return None
+    
+    # Get an example string that triggers both to show the user
+    if len(intersection.states) * max(len(intersection.alphabet), 1) > EXAMPLE_MAX_TRANSITIONS:
+        return "[example omitted: intersection too large]"
+    example = _shortest_example(intersection)
+    return "[Infinite possibilities]" if example is None else example
+
 class ConflictDetector:
     @staticmethod
     def check_overlap(new_pattern_str: str, existing_patterns: List[dict]) -> Tuple[bool, Optional[str]]:
@@ -15,7 +165,7 @@ class ConflictDetector:
             # 1. Parse the new regex into a Finite Automate (LEGO)
             # Note: Greenery is strict. We might need to sanitize input (e.g., ensure anchors)
             # We'll try to parse as is.
-            new_regex = parse(new_pattern_str)
+            _parse(new_pattern_str)
         except Exception as e:
             # If the regex is invalid/unsupported, we can't mathematically prove overlap.
             # Fail safe or let the user know their regex is too complex for verification.
@@ -25,23 +175,17 @@ class ConflictDetector:
             existing_str = rule['pattern']
             rule_id = rule['id']
             
+            # 2. Skip the FSM product entirely when literal prefixes already differ
+            if not _maybe_overlap(new_pattern_str, existing_str):
+                continue
+            
             try:
-                existing_regex = parse(existing_str)
-                
-                # 2. Calculate Intersection (A & B)
-                # This creates a new FSM accepting ONLY strings that match BOTH patterns
-                intersection = new_regex & existing_regex
+                # 3. Intersect (memoized per pattern pair)
+                example = _collision(*sorted((new_pattern_str, existing_str)))
                 
-                # 3. If Intersection is NOT empty, there is an overlap
-                if not intersection.empty():
+                # 4. If Intersection is NOT empty, there is an overlap
+                if example is not None:
                     # We found a conflict!
-                    # Get an example string that triggers both to show the user
-                    example_collision = intersection.strings()
-                    try:
-                        example = next(example_collision)
-                    except StopIteration:
-                        example = "[Infinite possibilities]"
-                    
                     return True, (
                         f"Conflict detected with Rule {rule_id} ('{existing_str}'). "
                         f"Both rules would match the command: '{example}'"
@@ -1,6 +1,8 @@
-from supabase import create_client, Client
-from typing import Optional
+import asyncpg
+from typing import Optional, Any, Dict
+from datetime import datetime
 import os
+import uuid
 from dotenv import load_dotenv
 import logging
 
@@ -8,34 +10,130 @@ load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-# Supabase connection
-supabase_url: str = os.environ.get("SUPABASE_URL")
-supabase_key: str = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+# Postgres connection (Supabase direct connection or pooler URL)
+database_url: str = os.environ.get("SUPABASE_DB_URL")
 
-if not supabase_url or not supabase_key:
-    raise ValueError("SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY must be set in environment")
+if not database_url:
+    raise ValueError("SUPABASE_DB_URL must be set in environment")
 
-supabase: Client = create_client(supabase_url, supabase_key)
+POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 5))
+POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 15))
+POOL_MAX_INACTIVE_LIFETIME = 300  # seconds
+# Default per-query timeout so a stuck query can't hold a pooled connection
+POOL_COMMAND_TIMEOUT = float(os.environ.get("DB_COMMAND_TIMEOUT", 5))
+# Startup DDL and bulk log COPYs may outlast that; asyncpg treats
+# timeout=None as "use the pool default", so they pass this explicitly
+LONG_COMMAND_TIMEOUT = float(os.environ.get("DB_LONG_COMMAND_TIMEOUT", 600))
+
+# Columns served by the rules endpoints (matches RuleResponse)
+RULE_COLUMNS = "id, pattern, action, description, is_active, created_at"
+
+# NOTIFY channel fired by the rules table trigger (see init_db)
+RULES_CHANNEL = "rules_changed"
+
+RULES_NOTIFY_SQL = f"""
+CREATE OR REPLACE FUNCTION notify_rules_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{RULES_CHANNEL}', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER rules_changed
+    AFTER INSERT OR UPDATE OR DELETE ON rules
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_rules_changed();
+"""
+
+# Indexes for the hot queries: active rules in FIFO order, the full rules
+# listing, per-user command history newest-first, and API key lookups
+INDEXES_SQL = (
+    "CREATE INDEX IF NOT EXISTS rules_active_created_idx "
+    "ON rules (created_at) WHERE is_active = true",
+    "CREATE INDEX IF NOT EXISTS rules_created_idx "
+    "ON rules (created_at)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS app_users_api_key_idx "
+    "ON app_users (api_key)",
+    "CREATE INDEX IF NOT EXISTS cmd_user_time_idx "
+    "ON command_logs (user_id, created_at DESC)",
+)
+
+# Created once in the app lifespan, shared by every request
+pool: Optional[asyncpg.Pool] = None
+
+async def init_pool() -> asyncpg.Pool:
+    """Create the shared connection pool (idempotent - one pool per process)"""
+    global pool
+    if pool is not None:
+        return pool
+    pool = await asyncpg.create_pool(
+        dsn=database_url,
+        min_size=POOL_MIN_SIZE,
+        max_size=POOL_MAX_SIZE,
+        max_inactive_connection_lifetime=POOL_MAX_INACTIVE_LIFETIME,
+        command_timeout=POOL_COMMAND_TIMEOUT,
+        # Supabase pooler runs pgBouncer in transaction mode, which
+        # cannot keep server-side prepared statements around
+        statement_cache_size=0,
+    )
+    logger.info(f"✓ Database pool ready (min={POOL_MIN_SIZE}, max={POOL_MAX_SIZE})")
+    return pool
+
+async def close_pool():
+    """Close the shared connection pool"""
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
+
+def get_pool() -> asyncpg.Pool:
+    """Return the shared pool (raises if the app has not started yet)"""
+    if pool is None:
+        raise RuntimeError("Database pool is not initialized")
+    return pool
+
+def record_to_dict(record: asyncpg.Record) -> Dict[str, Any]:
+    """Convert a row to a plain dict with JSON-friendly values (str ids, ISO timestamps)"""
+    row = {}
+    for key, value in record.items():
+        if isinstance(value, uuid.UUID):
+            value = str(value)
+        elif isinstance(value, datetime):
+            value = value.isoformat()
+        row[key] = value
+    return row
 
 async def init_db():
     """Initialize database with seed data"""
     
-    # Check if admin user exists
+    # Seed initial admin user unless it already exists (single round-trip)
     try:
-        response = supabase.table("app_users").select("*").eq("api_key", "admin_key_2025").execute()
+        seeded = await get_pool().fetchval(
+            "INSERT INTO app_users (name, role, credits, api_key) "
+            "SELECT $1, $2, $3, $4::text "
+            "WHERE NOT EXISTS (SELECT 1 FROM app_users WHERE api_key = $4::text) "
+            "RETURNING id",
+            'Admin User', 'admin', 1000, 'admin_key_2025'
+        )
         
-        if not response.data:
-            # Seed initial admin user
-            admin_user = {
-                'name': 'Admin User',
-                'role': 'admin',
-                'credits': 1000,
-                'api_key': 'admin_key_2025'
-            }
-            supabase.table("app_users").insert(admin_user).execute()
+        if seeded:
             logger.info("✓ Admin user seeded: admin_key_2025")
         else:
             logger.info("✓ Admin user already exists")
     except Exception as e:
         logger.error(f"Error initializing database: {e}")
         raise
+    
+    # Indexes are idempotent; a missing privilege only costs query speed
+    for statement in INDEXES_SQL:
+        try:
+            await get_pool().execute(statement, timeout=LONG_COMMAND_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Could not create index ({statement}): {e}")
+    
+    # Rule mutations NOTIFY every worker's rule cache (optional - caches
+    # fall back to periodic refresh if this can't be installed)
+    try:
+        await get_pool().execute(RULES_NOTIFY_SQL, timeout=LONG_COMMAND_TIMEOUT)
+        logger.info(f"✓ Rules change trigger installed ({RULES_CHANNEL})")
+    except Exception as e:
+        logger.warning(f"Could not install rules change trigger: {e}")
@@ -1,8 +1,33 @@
+import re
 import shlex
 import logging
 
 logger = logging.getLogger(__name__)
 
+RISKY_FLAG_SCORE = 20
+
+# shlex (posix, no comments) only treats quotes and backslashes specially and
+# splits on these four whitespace characters; without the specials a regex
+# split gives identical tokens without building a shlex lexer per command
+_SHLEX_SPECIALS = re.compile(r"['\"\\]")
+_SHLEX_TOKEN = re.compile(r"[^ \t\r\n]+")
+
+def _tokenize(command_text: str):
+    if _SHLEX_SPECIALS.search(command_text) is None:
+        return _SHLEX_TOKEN.findall(command_text)
+    return shlex.split(command_text)
+
+def _build_flag_table(risky_flags, force_flags, recursive_flags):
+    """token -> (flag score, sets has_force, sets has_recursive)"""
+    return {
+        flag: (
+            RISKY_FLAG_SCORE if flag in risky_flags else 0,
+            flag in force_flags,
+            flag in recursive_flags,
+        )
+        for flag in set(risky_flags) | set(force_flags) | set(recursive_flags)
+    }
+
 class CommandGuard:
     """
     Layer 2: Heuristic Risk Scoring
@@ -49,6 +74,15 @@ class CommandGuard:
     
     # Critical targets
     CRITICAL_TARGETS = ['/', '/etc', '/var', '/boot', '/bin', '/sbin', '/usr/bin', '/usr/sbin']
+    
+    FORCE_FLAGS = ['-f', '--force']
+    RECURSIVE_FLAGS = ['-r', '-R', '--recursive']
+    
+    # Lookup structures precomputed once (hot path runs on every command)
+    # One dict probe per token replaces three membership tests
+    _FLAG_TABLE = _build_flag_table(RISKY_FLAGS, FORCE_FLAGS, RECURSIVE_FLAGS)
+    _CRITICAL_SET = frozenset(CRITICAL_TARGETS)
+    _CRITICAL_PREFIXES = tuple(critical + '/' for critical in CRITICAL_TARGETS)
 
     @classmethod
     def analyze(cls, command_text: str):
@@ -65,7 +99,7 @@ class CommandGuard:
             
         try:
             # Split command safely
-            tokens = shlex.split(command_text)
+            tokens = _tokenize(command_text)
         except ValueError:
             # If shlex fails, it's likely a complex or malformed command -> High Risk
             return "BLOCK", 100, "Malformed command syntax"
@@ -85,24 +119,29 @@ class CommandGuard:
         has_force = False
         has_recursive = False
         
+        flag_table = cls._FLAG_TABLE
+        critical_set = cls._CRITICAL_SET
+        critical_prefixes = cls._CRITICAL_PREFIXES
+        
         for token in tokens[1:]:
-            if token in cls.RISKY_FLAGS:
-                score += 20
-                reasons.append(f"Risky flag '{token}' (+20)")
-                
-            if token in ['-f', '--force']:
-                has_force = True
-            if token in ['-r', '-R', '--recursive']:
-                has_recursive = True
+            flag = flag_table.get(token)
+            if flag is not None:
+                flag_score, is_force, is_recursive = flag
+                if flag_score:
+                    score += flag_score
+                    reasons.append(f"Risky flag '{token}' (+{flag_score})")
+                has_force = has_force or is_force
+                has_recursive = has_recursive or is_recursive
+                # Flags never look like paths - skip target analysis
+                continue
                 
             # 3. Target Analysis
             # Check if token looks like a critical path
             # Simple check: exact match or starts with critical path
-            for critical in cls.CRITICAL_TARGETS:
-                if token == critical or (token.startswith(critical + '/') and len(token) > len(critical)):
-                    score += 100
-                    reasons.append(f"Critical target '{token}' (+100)")
-                    break
+            # (a single str.startswith over the prefix tuple)
+            if token in critical_set or token.startswith(critical_prefixes):
+                score += 100
+                reasons.append(f"Critical target '{token}' (+100)")
         
         # Bonus Risk: rm -rf
         if binary == 'rm' and has_force and has_recursive:
@@ -1,7 +1,11 @@
-from pydantic import BaseModel, Field
-from typing import Optional, Literal
+from pydantic import BaseModel, ConfigDict, Field
+from typing import List, Optional, Literal
 from datetime import datetime
-import uuid
+import secrets
+
+def _short_id(prefix: str) -> str:
+    """prefix_ + 8 hex chars from 4 random bytes (no uuid4 + hex + slice)"""
+    return f"{prefix}_{secrets.token_hex(4)}"
 
 # ============ User Models ============
 
@@ -38,7 +42,7 @@ class UpdateCredits(BaseModel):
 # ============ Rule Models ============
 
 class Rule(BaseModel):
-    id: str = Field(default_factory=lambda: f"rule_{uuid.uuid4().hex[:8]}")
+    id: str = Field(default_factory=lambda: _short_id("rule"))
     pattern: str
     action: Literal["AUTO_ACCEPT", "AUTO_REJECT"]
     description: str = ""
@@ -64,22 +68,8 @@ class RuleResponse(BaseModel):
 class CommandExecutionRequest(BaseModel):
     command_text: str
 
-class CommandExecution(BaseModel):
-    id: str = Field(default_factory=lambda: f"cmd_{uuid.uuid4().hex[:8]}")
-    user_id: str
-    command_text: str
-    status: Literal["EXECUTED", "BLOCKED", "NO_MATCH", "INSUFFICIENT_CREDITS"]
-    verdict_source: Optional[str] = None # Was 'layer'
-    risk_score: int = 0 # Was 'score'
-    reason: Optional[str] = None # Not in DB schema but useful for response? User didn't include it in DB.
-    # User schema: id, user_id, command_text, status, verdict_source, risk_score, created_at.
-    # 'reason' and 'matched_rule' are NOT in the DB schema provided.
-    # We will return them in API response but NOT save them to DB unless we add columns.
-    # User said "i have only three tables... and i will provide the schema".
-    # So we must NOT try to insert 'reason' or 'matched_rule' into DB.
-    
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
-    execution_time_ms: float = 0.0
+class CommandBatchRequest(BaseModel):
+    commands: List[str] = Field(min_length=1, max_length=100)
 
 class CommandExecutionResponse(BaseModel):
     status: str
@@ -107,3 +97,12 @@ class InsufficientCreditsResponse(BaseModel):
     status: str = "INSUFFICIENT_CREDITS"
     message: str = "No credits available"
     remaining_credits: int = 0
+
+# ============ AI Judge Models ============
+
+class AIVerdict(BaseModel):
+    """Layer 3 reply from Gemini, parsed and validated straight from JSON"""
+    model_config = ConfigDict(frozen=True)
+    
+    status: Literal["EXECUTED", "BLOCKED"]
+    reason: str
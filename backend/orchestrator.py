@@ -1,8 +1,8 @@
 import logging
-import re
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
-from database import supabase
+from rule_cache import RuleCache
+from rule_matcher import MatchTimeout
 from guard import CommandGuard
 from ai_judge import judge_command
 
@@ -14,9 +14,10 @@ class CommandOrchestrator:
     """
     
     @staticmethod
-    async def process_command(command_text: str) -> Dict[str, Any]:
+    async def process_command(command_text: str, user_id: Optional[str] = None) -> Dict[str, Any]:
         """
         Process a command through the 3 layers.
+        user_id (optional) scopes Layer 3 rate limiting.
         Returns:
         {
             "status": "EXECUTED" | "BLOCKED",
@@ -32,45 +33,45 @@ class CommandOrchestrator:
         # LAYER 1: The Constitution (Admin Rules)
         # =================================================
         try:
-            # Fetch ALL ACTIVE rules from Supabase, sorted by created_at (FIFO)
-            # Note: In a real high-perf app, we'd cache this.
-            response = supabase.table("rules").select("*").eq("is_active", True).order("created_at").execute()
-            rules = response.data
+            # ALL ACTIVE rules, sorted by created_at (FIFO), precompiled into one matcher
+            matcher = await RuleCache.get_matcher()
             
-            logger.info(f"Layer 1: Checking command '{command_text}' against {len(rules)} active rules")
+            logger.info(f"Layer 1: Checking command '{command_text}' against {len(matcher.rules)} active rules")
             
             l1_decision = "NO_MATCH"
             matched_rule_id = None
             
-            # Check EVERY rule for a match
-            for rule in rules:
-                logger.debug(f"Layer 1: Testing pattern '{rule['pattern']}' against '{command_text}'")
-                try:
-                    # Use re.search to check if pattern matches the command
-                    if re.search(rule['pattern'], command_text):
-                        matched_rule_id = rule['id']
-                        logger.info(f"Layer 1 MATCH FOUND: Pattern '{rule['pattern']}' matched command '{command_text}' - Action: {rule['action']}")
-                        
-                        if rule['action'] == "AUTO_REJECT":
-                            # 🛑 FINAL BLOCK - Admin explicitly forbidden
-                            logger.info(f"Layer 1 BLOCK: Rule {matched_rule_id} ('{rule['pattern']}') - AUTO_REJECT")
-                            return {
-                                "status": "BLOCKED",
-                                "layer": "1_RULES",
-                                "score": 0,
-                                "reason": f"Admin Explicitly Forbidden: {rule.get('description', 'No description')}",
-                                "matched_rule": matched_rule_id
-                            }
-                        elif rule['action'] == "AUTO_ACCEPT":
-                            # Proceed to Layer 2 for verification (Do not trust blindly)
-                            l1_decision = "AUTO_ACCEPT"
-                            logger.info(f"Layer 1 AUTO_ACCEPT: Rule {matched_rule_id} ('{rule['pattern']}') matched - proceeding to Layer 2 verification")
-                            break # First matching AUTO_ACCEPT rule wins
-                            
-                except re.error as regex_err:
-                    logger.error(f"Invalid regex in rule {rule['id']}: {regex_err}")
-                    continue
+            # Single scan over EVERY rule; the first matching rule (FIFO) wins
+            rule = matcher.first_match(command_text)
+            if rule is not None:
+                matched_rule_id = rule['id']
+                logger.info(f"Layer 1 MATCH FOUND: Pattern '{rule['pattern']}' matched command '{command_text}' - Action: {rule['action']}")
+                
+                if rule['action'] == "AUTO_REJECT":
+                    # 🛑 FINAL BLOCK - Admin explicitly forbidden
+                    logger.info(f"Layer 1 BLOCK: Rule {matched_rule_id} ('{rule['pattern']}') - AUTO_REJECT")
+                    return {
+                        "status": "BLOCKED",
+                        "layer": "1_RULES",
+                        "score": 0,
+                        "reason": f"Admin Explicitly Forbidden: {rule.get('description', 'No description')}",
+                        "matched_rule": matched_rule_id
+                    }
+                elif rule['action'] == "AUTO_ACCEPT":
+                    # Proceed to Layer 2 for verification (Do not trust blindly)
+                    l1_decision = "AUTO_ACCEPT"
+                    logger.info(f"Layer 1 AUTO_ACCEPT: Rule {matched_rule_id} ('{rule['pattern']}') matched - proceeding to Layer 2 verification")
                     
+        except MatchTimeout as e:
+            # Fail closed: an AUTO_REJECT rule may match but couldn't be decided
+            logger.warning(f"Layer 1 BLOCK: {e} on command '{command_text}' - failing closed")
+            return {
+                "status": "BLOCKED",
+                "layer": "1_RULES",
+                "score": 0,
+                "reason": "Rule evaluation timed out; blocked as a precaution",
+                "matched_rule": e.rule['id']
+            }
         except Exception as e:
             logger.error(f"Layer 1 Error: {e}")
             # Fail safe: If DB fails, proceed to Layer 2 but log error
@@ -134,7 +135,7 @@ class CommandOrchestrator:
         # =================================================
         logger.info("Escalating to Layer 3 (AI Judge)...")
         
-        ai_result = await judge_command(command_text)
+        ai_result = await judge_command(command_text, user_id)
         
         logger.info(f"Layer 3 AI Response: {ai_result}")
         logger.info(f"Layer 3 Decision: {ai_result['status']} - Reason: {ai_result['reason']}")
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+from typing import List, Dict, Any, Optional
+
+import asyncpg
+
+from database import get_pool, record_to_dict, database_url, RULES_CHANNEL, RULE_COLUMNS
+from rule_matcher import RuleMatcher
+from conflict import PrefixIndex
+
+logger = logging.getLogger(__name__)
+
+class RuleCache:
+    """
+    In-process snapshot of the active rules used by Layer 1.
+    
+    A background task started in the app lifespan reloads the snapshot every
+    REFRESH_SECONDS, and immediately when Postgres sends a NOTIFY on
+    RULES_CHANNEL (any worker's rule mutation), so commands read it with zero
+    I/O. If the refresher isn't running, a request reloads a snapshot older
+    than TTL_SECONDS itself. The compiled RuleMatcher is built once per
+    distinct ruleset (keyed by the rules' contents), never per request.
+    """
+    
+    TTL_SECONDS = 30
+    REFRESH_SECONDS = 15
+    
+    _matcher: Optional[RuleMatcher] = None
+    # Last matcher built and the ruleset it was built from; periodic reloads
+    # of an unchanged ruleset reuse it instead of recompiling the union
+    _built: Optional[RuleMatcher] = None
+    _built_key: tuple = ()
+    # Every rule (active or not) for the admin listing, loaded on demand
+    _all_rules: Optional[List[Dict[str, Any]]] = None
+    _all_loaded_at = 0.0
+    _prefix_index: Optional[PrefixIndex] = None
+    _loaded_at = 0.0
+    _lock = asyncio.Lock()
+    _generation = 0
+    _wakeup = asyncio.Event()
+    _task: Optional[asyncio.Task] = None
+    _listener: Optional[asyncpg.Connection] = None
+    
+    @classmethod
+    def _is_fresh(cls) -> bool:
+        return cls._matcher is not None and time.monotonic() - cls._loaded_at < cls.TTL_SECONDS
+    
+    @classmethod
+    async def _load(cls, force: bool = False) -> RuleMatcher:
+        # Only one load at a time; waiters reuse its result unless forced
+        async with cls._lock:
+            if not force and cls._is_fresh():
+                return cls._matcher
+            generation = cls._generation
+            rows = await get_pool().fetch(
+                "SELECT id, pattern, action, description FROM rules "
+                "WHERE is_active = true ORDER BY created_at"
+            )
+            rules = [record_to_dict(r) for r in rows]
+            key = tuple((r['id'], r['pattern'], r['action'], r['description']) for r in rules)
+            if cls._built is not None and cls._built_key == key:
+                # Unchanged ruleset: keep the compiled matcher
+                matcher = cls._built
+            else:
+                matcher = RuleMatcher(rules)
+                cls._built, cls._built_key = matcher, key
+            # Don't store a snapshot that was invalidated mid-fetch
+            if generation == cls._generation:
+                cls._matcher = matcher
+                cls._loaded_at = time.monotonic()
+            logger.debug(f"Rule cache loaded {len(matcher.rules)} active rules")
+            return matcher
+    
+    @classmethod
+    async def get_matcher(cls) -> RuleMatcher:
+        """Return the matcher for ALL ACTIVE rules sorted by created_at (FIFO)"""
+        if cls._is_fresh():
+            return cls._matcher
+        return await cls._load()
+    
+    @classmethod
+    async def get_all_rules(cls) -> List[Dict[str, Any]]:
+        """Return ALL rules (including inactive) sorted by created_at"""
+        if cls._all_rules is not None and time.monotonic() - cls._all_loaded_at < cls.TTL_SECONDS:
+            return cls._all_rules
+        generation = cls._generation
+        rows = await get_pool().fetch(f"SELECT {RULE_COLUMNS} FROM rules ORDER BY created_at")
+        rules = [record_to_dict(r) for r in rows]
+        if generation == cls._generation:
+            cls._all_rules = rules
+            cls._all_loaded_at = time.monotonic()
+        return rules
+    
+    @classmethod
+    async def get_prefix_index(cls) -> PrefixIndex:
+        """ALL rules bucketed by literal prefix, for rule conflict checks"""
+        rules = await cls.get_all_rules()
+        index = cls._prefix_index
+        if index is None or index.rules is not rules:
+            index = cls._prefix_index = PrefixIndex(rules)
+        return index
+    
+    @classmethod
+    def invalidate(cls):
+        """Drop the snapshot after a local rule mutation and wake the refresher"""
+        cls._generation += 1
+        cls._matcher = None
+        cls._all_rules = None
+        cls._wakeup.set()
+    
+    @classmethod
+    def _on_notify(cls, connection, pid, channel, payload):
+        # Another worker (or this one) changed the rules table
+        cls._generation += 1
+        cls._all_rules = None
+        cls._wakeup.set()
+    
+    @classmethod
+    async def _refresh_loop(cls):
+        while True:
+            cls._wakeup.clear()
+            try:
+                await cls._load(force=True)
+            except Exception as e:
+                logger.error(f"Rule cache refresh failed: {e}")
+            try:
+                await asyncio.wait_for(cls._wakeup.wait(), timeout=cls.REFRESH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+    
+    @classmethod
+    async def start(cls):
+        """Start the background refresher and the LISTEN connection (best effort)"""
+        try:
+            cls._listener = await asyncpg.connect(dsn=database_url, statement_cache_size=0)
+            await cls._listener.add_listener(RULES_CHANNEL, cls._on_notify)
+            logger.info(f"✓ Rule cache listening on '{RULES_CHANNEL}'")
+        except Exception as e:
+            cls._listener = None
+            logger.warning(f"Rule cache LISTEN unavailable, using {cls.REFRESH_SECONDS}s refresh only: {e}")
+        cls._task = asyncio.create_task(cls._refresh_loop())
+    
+    @classmethod
+    async def stop(cls):
+        """Stop the refresher and close the LISTEN connection"""
+        if cls._task is not None:
+            cls._task.cancel()
+            try:
+                await cls._task
+            except asyncio.CancelledError:
+                pass
+            cls._task = None
+        if cls._listener is not None:
+            await cls._listener.close()
+            cls._listener = None
@@ -0,0 +1,259 @@
+import re
+import time
+import logging
+from functools import lru_cache
+from typing import List, Dict, Any, Optional
+
+import regex
+
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+
+from conflict import literal_prefix
+
+try:
+    import ahocorasick
+except ImportError:  # optional accelerator for the literal pre-screen
+    ahocorasick = None
+
+logger = logging.getLogger(__name__)
+
+PATTERN_CACHE_SIZE = 4096
+
+# Rules are matched with the `regex` module so a pathological pattern can't
+# hang the event loop: all searches for one command share a budget of
+# MATCH_BUDGET_SECONDS. A search that runs out fails closed for AUTO_REJECT
+# rules (MatchTimeout) and counts as no match for AUTO_ACCEPT rules.
+MATCH_BUDGET_SECONDS = 0.05
+
+class UnsafePattern(ValueError):
+    """Pattern is valid but prone to catastrophic backtracking"""
+
+class MatchTimeout(Exception):
+    """An AUTO_REJECT rule couldn't be evaluated within the match budget"""
+    
+    def __init__(self, rule: Dict[str, Any]):
+        super().__init__(f"Rule {rule['id']} timed out")
+        self.rule = rule
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_pattern(pattern: str) -> regex.Pattern:
+    """
+    Compile a rule pattern once per process. Shared by rule validation and
+    every matcher rebuild; raises regex.error for invalid patterns (not cached).
+    
+    Matching uses `regex` semantics, which differ from `re` in a few Unicode
+    classes: e.g. `\\s` follows the Unicode White_Space property, so it does
+    not match the \\x1c-\\x1f separators that `re` treats as whitespace.
+    """
+    return regex.compile(pattern)
+
+_UNBOUNDED_REPEATS = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+
+def _subpatterns(op, av):
+    # Atomic groups and possessive repeats never backtrack: not walked
+    if op in _UNBOUNDED_REPEATS:
+        yield av[2]
+    elif op is sre_parse.SUBPATTERN:
+        yield av[3]
+    elif op is sre_parse.BRANCH:
+        yield from av[1]
+    elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+        yield av[1]
+    elif op is sre_parse.GROUPREF_EXISTS:
+        yield av[1]
+        if av[2] is not None:
+            yield av[2]
+
+def _has_nested_unbounded(parsed, inside_unbounded: bool = False) -> bool:
+    for op, av in parsed:
+        unbounded = op in _UNBOUNDED_REPEATS and av[1] == sre_parse.MAXREPEAT
+        if unbounded and inside_unbounded:
+            return True
+        for sub in _subpatterns(op, av):
+            if _has_nested_unbounded(sub, inside_unbounded or unbounded):
+                return True
+    return False
+
+def validate_pattern(pattern: str):
+    """
+    Check a rule pattern before it is stored: re.error if it isn't valid
+    Python regex syntax, UnsafePattern for nested unbounded quantifiers
+    such as (a+)+ that backtrack exponentially, regex.error if the matching
+    engine rejects it. Stored rules are matched with `regex` semantics
+    (see compile_pattern).
+    """
+    if _has_nested_unbounded(sre_parse.parse(pattern)):
+        raise UnsafePattern("nested unbounded quantifiers (e.g. '(a+)+') can backtrack catastrophically")
+    compile_pattern(pattern)
+
+# Constructs that can't be embedded in a larger alternation without changing
+# meaning: numbered/named backrefs and conditionals (group numbers shift)
+_UNSAFE_TO_UNION = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+# Flags every compiled pattern carries; anything beyond them is an inline
+# global flag that would leak into the rest of a union
+_DEFAULT_FLAGS = regex.compile("").flags
+
+class RuleMatcher:
+    """
+    Precompiled Layer 1 matcher built once per rules snapshot.
+    
+    Consecutive rules are unioned into a single regex so a command is checked
+    against the whole ruleset in one C-level scan. Each rule becomes an
+    alternative `(?=.*?(?:pattern))(?P<rN>)` anchored at the start of the
+    command, so the FIRST rule (in created_at order) that re.search() would
+    match is the one reported - same semantics as the old per-rule loop.
+    Patterns that can't be safely embedded (inline global flags, named
+    groups, backrefs) are matched on their own, in order.
+    
+    When the optional `pyahocorasick` package is installed, rules whose
+    pattern starts with a required literal are screened by one Aho-Corasick
+    pass and only rules whose literal occurs are run.
+    """
+    
+    def __init__(self, rules: List[Dict[str, Any]]):
+        self.rules = rules
+        # Every valid rule compiled exactly once, in order: [(rule, compiled)]
+        self.compiled = []
+        for rule in rules:
+            try:
+                self.compiled.append((rule, compile_pattern(rule['pattern'])))
+            except regex.error as regex_err:
+                # Logged once per snapshot, not once per command
+                logger.error(f"Invalid regex in rule {rule['id']}: {regex_err}")
+        
+        # Ordered list of (compiled regex, {group_name: index} or None, index or None);
+        # indexes point into self.compiled
+        self._segments = self._build_segments(range(len(self.compiled)))
+        
+        self._literals = None
+        # Segments over the rules with no required literal (always evaluated)
+        self._unscreened = []
+        if ahocorasick is not None and self.compiled:
+            self._build_literal_screen()
+    
+    def _build_literal_screen(self):
+        # literal -> indexes of the rules that require it
+        by_literal = {}
+        unscreened = []
+        for index, (rule, _) in enumerate(self.compiled):
+            literal = literal_prefix(rule['pattern'])
+            if literal:
+                by_literal.setdefault(literal, []).append(index)
+            else:
+                unscreened.append(index)
+        if not by_literal:
+            return
+        automaton = ahocorasick.Automaton()
+        for literal, indexes in by_literal.items():
+            automaton.add_word(literal, tuple(indexes))
+        automaton.make_automaton()
+        self._literals = automaton
+        self._unscreened = self._build_segments(unscreened)
+    
+    def _first_match_screened(self, command_text: str, deadline: float) -> Optional[int]:
+        # Rules without a literal can't be screened; find the first of them
+        # that matches, then only earlier screened rules can still win
+        first = self._scan(self._unscreened, command_text, deadline)
+        candidates = set()
+        for _, indexes in self._literals.iter(command_text):
+            candidates.update(indexes)
+        for index in sorted(candidates):
+            if first is not None and index > first:
+                break
+            if self._search(index, command_text, deadline):
+                return index
+        return first
+    
+    @staticmethod
+    def _can_union(compiled: regex.Pattern) -> bool:
+        return (
+            not (compiled.flags & ~_DEFAULT_FLAGS)
+            and not compiled.groupindex
+            and not _UNSAFE_TO_UNION.search(compiled.pattern)
+        )
+    
+    def _build_segments(self, indexes) -> list:
+        segments = []
+        pending = []
+        for index in indexes:
+            if self._can_union(self.compiled[index][1]):
+                pending.append(index)
+            else:
+                self._flush(pending, segments)
+                pending = []
+                segments.append((self.compiled[index][1], None, index))
+        self._flush(pending, segments)
+        return segments
+    
+    def _flush(self, pending: List[int], segments: list):
+        if not pending:
+            return
+        groups = {}
+        alternatives = []
+        for index in pending:
+            name = f"r{len(groups)}"
+            groups[name] = index
+            alternatives.append(f"(?=(?s:.*?)(?:{self.compiled[index][0]['pattern']}))(?P<{name}>)")
+        try:
+            union = regex.compile("|".join(alternatives))
+        except regex.error as regex_err:
+            # Never lose Layer 1 over the union: match these rules one by one
+            logger.warning(f"Rule union failed, matching {len(pending)} rules individually: {regex_err}")
+            segments.extend((self.compiled[index][1], None, index) for index in pending)
+            return
+        segments.append((union, groups, None))
+    
+    def _timed_out(self, indexes) -> None:
+        """A search over these rules ran out of budget: fail closed on AUTO_REJECT"""
+        for index in indexes:
+            rule = self.compiled[index][0]
+            if rule['action'] == "AUTO_REJECT":
+                raise MatchTimeout(rule)
+        logger.warning(f"{len(indexes)} AUTO_ACCEPT rule(s) timed out matching a command - treated as no match")
+    
+    def _search(self, index: int, command_text: str, deadline: float) -> bool:
+        remaining = deadline - time.monotonic()
+        try:
+            if remaining <= 0:
+                raise TimeoutError
+            return self.compiled[index][1].search(command_text, timeout=remaining) is not None
+        except TimeoutError:
+            self._timed_out((index,))
+            return False
+    
+    def _scan(self, segments: list, command_text: str, deadline: float) -> Optional[int]:
+        for union, groups, index in segments:
+            if groups is None:
+                if self._search(index, command_text, deadline):
+                    return index
+                continue
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    raise TimeoutError
+                m = union.match(command_text, timeout=remaining)
+            except TimeoutError:
+                # Not retried rule by rule: the budget is per command
+                self._timed_out(groups.values())
+                continue
+            if m:
+                return groups[m.lastgroup]
+        return None
+    
+    def first_match(self, command_text: str) -> Optional[Dict[str, Any]]:
+        """
+        Return the first rule whose pattern matches command_text, if any.
+        Raises MatchTimeout if an AUTO_REJECT rule can't be evaluated within
+        MATCH_BUDGET_SECONDS (callers must block the command).
+        """
+        deadline = time.monotonic() + MATCH_BUDGET_SECONDS
+        index = None
+        if self._literals is not None:
+            index = self._first_match_screened(command_text, deadline)
+        else:
+            index = self._scan(self._segments, command_text, deadline)
+        return self.compiled[index][0] if index is not None else None
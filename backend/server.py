@@ -1,10 +1,14 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from dotenv import load_dotenv
+from contextlib import asynccontextmanager
 from pathlib import Path
 import os
+import asyncio
 import logging
 import re
+import regex
 from datetime import datetime
 from typing import List, Optional
 import time
@@ -13,20 +17,48 @@ import uuid
 from models import (
     UserCreate, UserResponse, UserResponseWithKey, UserVerifyResponse, UpdateCredits,
     RuleCreate, RuleResponse,
-    CommandExecutionRequest, CommandExecutionResponse, 
+    CommandExecutionRequest, CommandBatchRequest, CommandExecutionResponse, 
     CommandHistoryResponse, InsufficientCreditsResponse
 )
-from auth import get_current_user, get_admin_user, UserPayload
-from database import init_db, supabase
+from auth import get_current_user, get_admin_user, UserPayload, cache_user, update_cached_credits, invalidate_user
+from database import init_db, init_pool, close_pool, get_pool, record_to_dict, RULE_COLUMNS
 from orchestrator import CommandOrchestrator
 from conflict import ConflictDetector
+from rule_cache import RuleCache
+from rule_matcher import validate_pattern, UnsafePattern
+from ai_judge import start_workers, stop_workers
+from command_log import log_command, log_commands, start_log_writer, stop_log_writer
 
 # Setup
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# ============ Lifespan ============
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the connection pool once, seed the database, warm the rule cache"""
+    await init_pool()
+    await init_db()
+    logger.info("✓ Database initialized")
+    await RuleCache.start()
+    await start_workers()
+    await start_log_writer()
+    yield
+    await stop_log_writer()
+    await stop_workers()
+    await RuleCache.stop()
+    await close_pool()
+
 # Create the main app without a prefix
-app = FastAPI(title="Unbound Command Gateway API")
+app = FastAPI(title="Unbound Command Gateway API", lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -40,21 +72,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
-
-# ============ Startup Event ============
-
-@app.on_event("startup")
-async def startup_event():
-    """Initialize database on startup"""
-    await init_db()
-    logger.info("✓ Database initialized")
-
 # ============ Health Check ============
 
 @api_router.get("/")
@@ -82,16 +99,9 @@ async def verify_api_key(user: UserPayload = Depends(get_current_user)):
 async def get_all_users(admin: UserPayload = Depends(get_admin_user)):
     """Get all users (Admin only) - NEVER returns api_key for security"""
     try:
-        response = supabase.table("app_users").select("id, name, role, credits, created_at").execute()
-        return [
-            UserResponse(
-                id=u['id'],
-                name=u['name'],
-                role=u['role'],
-                credits=u['credits'],
-                created_at=u.get('created_at')
-            ) for u in response.data
-        ]
+        rows = await get_pool().fetch("SELECT id, name, role, credits, created_at FROM app_users")
+        # Trusted DB rows: build without re-validating each field
+        return [UserResponse.model_construct(**record_to_dict(u)) for u in rows]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
@@ -109,32 +119,26 @@ async def create_user(
     # Let's generate it here to show it to the user once.
     new_api_key = f"uk_{uuid.uuid4().hex}"
     
-    # 2. Insert into Supabase
-    user_payload = {
-        "name": user_data.name,
-        "role": user_data.role,
-        "credits": 10,
-        "api_key": new_api_key
-    }
-    
+    # 2. Insert into Postgres
     try:
-        response = supabase.table("app_users").insert(user_payload).execute()
+        row = await get_pool().fetchrow(
+            "INSERT INTO app_users (name, role, credits, api_key) VALUES ($1, $2, $3, $4) "
+            "RETURNING id, name, role, credits, api_key",
+            user_data.name, user_data.role, 10, new_api_key
+        )
         
-        if not response.data:
+        if row is None:
             raise HTTPException(status_code=500, detail="Failed to create user")
         
-        new_user = response.data[0]
+        new_user = record_to_dict(row)
         
         logger.info(f"Admin {admin.id} created user {new_user['id']}")
         
+        # Pre-warm the auth cache so the user's first request skips the DB
+        cache_user(new_api_key, UserPayload.model_construct(**new_user))
+        
         # 3. Return the key (This is the "Once" part)
-        return UserResponseWithKey(
-            id=new_user['id'],
-            name=new_user['name'],
-            role=new_user['role'],
-            credits=new_user['credits'],
-            api_key=new_user['api_key']
-        )
+        return UserResponseWithKey.model_construct(**new_user)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
@@ -146,16 +150,23 @@ async def update_user_credits(
 ):
     """Update user credits (Admin only)"""
     try:
-        response = supabase.table("app_users").update(
-            {"credits": update_data.credits}
-        ).eq("id", user_id).execute()
+        # No-op updates (same balance) write nothing
+        row = await get_pool().fetchrow(
+            "UPDATE app_users SET credits = $1 WHERE id = $2 AND credits <> $1 RETURNING id",
+            update_data.credits, user_id
+        )
         
-        if not response.data:
+        # Nothing updated: either the balance already matches or the user is gone
+        if row is None and await get_pool().fetchval(
+            "SELECT 1 FROM app_users WHERE id = $1", user_id
+        ) is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="User not found"
             )
         
+        invalidate_user(user_id)
+        
         logger.info(f"Admin {admin.id} updated {user_id} credits to {update_data.credits}")
         
         return {
@@ -182,14 +193,18 @@ async def delete_user(
                 detail="Cannot delete your own account"
             )
         
-        response = supabase.table("app_users").delete().eq("id", user_id).execute()
+        row = await get_pool().fetchrow(
+            "DELETE FROM app_users WHERE id = $1 RETURNING id", user_id
+        )
         
-        if not response.data:
+        if row is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="User not found"
             )
         
+        invalidate_user(user_id)
+        
         logger.info(f"Admin {admin.id} deleted user {user_id}")
         
         return {
@@ -209,17 +224,8 @@ async def get_rules(user: UserPayload = Depends(get_current_user)):
     """Get all configured rules"""
     try:
         # No 'order' column in user schema, so sort by created_at
-        response = supabase.table("rules").select("*").order("created_at").execute()
-        return [
-            RuleResponse(
-                id=r['id'],
-                pattern=r['pattern'],
-                action=r['action'],
-                description=r.get('description', ''),
-                is_active=r.get('is_active', True),
-                created_at=r['created_at']
-            ) for r in response.data
-        ]
+        # Served from the in-process rule cache (dropped on every rule change)
+        return [RuleResponse.model_construct(**r) for r in await RuleCache.get_all_rules()]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
@@ -231,19 +237,27 @@ async def create_rule(
     """Create new rule (Admin only)"""
     # Validate regex pattern
     try:
-        re.compile(rule_data.pattern)
-    except re.error as e:
+        validate_pattern(rule_data.pattern)
+    except (re.error, regex.error) as e:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail=f"Invalid regex pattern: {str(e)}"
         )
+    except UnsafePattern as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Unsafe regex pattern: {str(e)}"
+        )
     
     # Check for conflicts
     try:
-        existing_rules_res = supabase.table("rules").select("id, pattern").execute()
-        existing_rules = existing_rules_res.data
+        # Only rules sharing a compatible literal prefix can overlap
+        existing_rules = (await RuleCache.get_prefix_index()).candidates(rule_data.pattern)
         
-        has_conflict, reason = ConflictDetector.check_overlap(rule_data.pattern, existing_rules)
+        # FSM intersection is CPU-bound: keep it off the event loop
+        has_conflict, reason = await run_in_threadpool(
+            ConflictDetector.check_overlap, rule_data.pattern, existing_rules
+        )
         
         if has_conflict:
             raise HTTPException(
@@ -261,30 +275,22 @@ async def create_rule(
     
     try:
         # No 'order' column
-        new_rule_payload = {
-            "pattern": rule_data.pattern,
-            "action": rule_data.action,
-            "description": rule_data.description,
-            "is_active": rule_data.is_active
-        }
-        
-        response = supabase.table("rules").insert(new_rule_payload).execute()
+        row = await get_pool().fetchrow(
+            "INSERT INTO rules (pattern, action, description, is_active) VALUES ($1, $2, $3, $4) "
+            f"RETURNING {RULE_COLUMNS}",
+            rule_data.pattern, rule_data.action, rule_data.description, rule_data.is_active
+        )
         
-        if not response.data:
+        if row is None:
             raise HTTPException(status_code=500, detail="Failed to create rule")
             
-        new_rule = response.data[0]
+        new_rule = record_to_dict(row)
+        RuleCache.invalidate()
         
         logger.info(f"Admin {admin.id} created rule {new_rule['id']}")
         
-        return RuleResponse(
-            id=new_rule['id'],
-            pattern=new_rule['pattern'],
-            action=new_rule['action'],
-            description=new_rule.get('description', ''),
-            is_active=new_rule.get('is_active', True),
-            created_at=new_rule['created_at']
-        )
+        # RETURNING gives exactly RuleResponse's fields, already JSON-typed
+        return RuleResponse.model_construct(**new_rule)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
@@ -295,14 +301,18 @@ async def delete_rule(
 ):
     """Delete a rule (Admin only)"""
     try:
-        response = supabase.table("rules").delete().eq("id", rule_id).execute()
+        row = await get_pool().fetchrow(
+            "DELETE FROM rules WHERE id = $1 RETURNING id", rule_id
+        )
         
-        if not response.data:
+        if row is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Rule not found"
             )
         
+        RuleCache.invalidate()
+        
         logger.info(f"Admin {admin.id} deleted rule {rule_id}")
         
         return {"success": True, "message": "Rule deleted"}
@@ -320,19 +330,30 @@ async def update_rule(
     """Update a rule (Admin only)"""
     # Validate regex pattern
     try:
-        re.compile(rule_data.pattern)
-    except re.error as e:
+        validate_pattern(rule_data.pattern)
+    except (re.error, regex.error) as e:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail=f"Invalid regex pattern: {str(e)}"
         )
+    except UnsafePattern as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Unsafe regex pattern: {str(e)}"
+        )
     
     # Check for conflicts
     try:
-        existing_rules_res = supabase.table("rules").select("id, pattern").neq("id", rule_id).execute()
-        existing_rules = existing_rules_res.data
+        # Only rules sharing a compatible literal prefix can overlap
+        existing_rules = [
+            r for r in (await RuleCache.get_prefix_index()).candidates(rule_data.pattern)
+            if r['id'] != rule_id
+        ]
         
-        has_conflict, reason = ConflictDetector.check_overlap(rule_data.pattern, existing_rules)
+        # FSM intersection is CPU-bound: keep it off the event loop
+        has_conflict, reason = await run_in_threadpool(
+            ConflictDetector.check_overlap, rule_data.pattern, existing_rules
+        )
         
         if has_conflict:
             raise HTTPException(
@@ -349,33 +370,26 @@ async def update_rule(
         )
     
     try:
-        update_payload = {
-            "pattern": rule_data.pattern,
-            "action": rule_data.action,
-            "description": rule_data.description,
-            "is_active": rule_data.is_active
-        }
-        
-        response = supabase.table("rules").update(update_payload).eq("id", rule_id).execute()
+        row = await get_pool().fetchrow(
+            "UPDATE rules SET pattern = $1, action = $2, description = $3, is_active = $4 "
+            f"WHERE id = $5 RETURNING {RULE_COLUMNS}",
+            rule_data.pattern, rule_data.action, rule_data.description, rule_data.is_active,
+            rule_id
+        )
         
-        if not response.data:
+        if row is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Rule not found"
             )
             
-        updated_rule = response.data[0]
+        updated_rule = record_to_dict(row)
+        RuleCache.invalidate()
         
         logger.info(f"Admin {admin.id} updated rule {rule_id}")
         
-        return RuleResponse(
-            id=updated_rule['id'],
-            pattern=updated_rule['pattern'],
-            action=updated_rule['action'],
-            description=updated_rule.get('description', ''),
-            is_active=updated_rule.get('is_active', True),
-            created_at=updated_rule['created_at']
-        )
+        # RETURNING gives exactly RuleResponse's fields, already JSON-typed
+        return RuleResponse.model_construct(**updated_rule)
     except HTTPException:
         raise
     except Exception as e:
@@ -396,7 +410,7 @@ async def execute_command(
         return InsufficientCreditsResponse(remaining_credits=0)
     
     # Process Command through Orchestrator
-    result = await CommandOrchestrator.process_command(request.command_text)
+    result = await CommandOrchestrator.process_command(request.command_text, user.id)
     
     command_status = result["status"]
     credits_to_deduct = 0
@@ -409,32 +423,37 @@ async def execute_command(
     new_credits = user.credits
     if credits_to_deduct > 0:
         try:
-            update_res = supabase.table("app_users").update(
-                {"credits": user.credits - credits_to_deduct}
-            ).eq("id", user.id).execute()
-            
-            if update_res.data:
-                new_credits = update_res.data[0]['credits']
+            # Atomic check-and-deduct: concurrent requests can't double-spend
+            updated = await get_pool().fetchval(
+                "UPDATE app_users SET credits = credits - $1 "
+                "WHERE id = $2 AND credits >= $1 RETURNING credits",
+                credits_to_deduct, user.id
+            )
         except Exception as e:
             logger.error(f"Failed to update credits: {e}")
             raise HTTPException(status_code=500, detail="Credit transaction failed")
+        
+        if updated is None:
+            # Balance ran out since the auth check (cached balance was stale)
+            invalidate_user(user.id)
+            return InsufficientCreditsResponse(remaining_credits=0)
+        
+        new_credits = updated
+        # Keep the auth cache in step with the new balance
+        update_cached_credits(user, new_credits)
     
     # Log command execution
     execution_time = (time.time() - start_time) * 1000  # Convert to ms
     
-    log_payload = {
-        "user_id": user.id,
-        "command_text": request.command_text,
-        "status": command_status,
-        "verdict_source": result.get("layer"), # Mapped from 'layer'
-        "risk_score": result.get("score", 0),  # Mapped from 'score'
-        # 'reason' and 'matched_rule' are NOT in DB schema, so we omit them
-    }
-    
-    try:
-        supabase.table("command_logs").insert(log_payload).execute()
-    except Exception as e:
-        logger.error(f"Failed to log command: {e}")
+    # 'reason' and 'matched_rule' are NOT in DB schema, so we omit them
+    # Queued for the background writer - the response doesn't wait on it
+    await log_command(
+        user.id,
+        request.command_text,
+        command_status,
+        result.get("layer"),     # Mapped from 'layer'
+        result.get("score", 0)   # Mapped from 'score'
+    )
     
     logger.info(
         f"User {user.id} executed: '{request.command_text}' "
@@ -453,6 +472,120 @@ async def execute_command(
         timestamp=datetime.utcnow().isoformat()
     )
 
+def _insufficient_batch(commands: List[str]) -> List[CommandExecutionResponse]:
+    """Per-item INSUFFICIENT_CREDITS results for a batch that can't run"""
+    timestamp = datetime.utcnow().isoformat()
+    return [
+        CommandExecutionResponse(
+            status="INSUFFICIENT_CREDITS",
+            command_text=command_text,
+            reason="No credits available",
+            credits_used=0,
+            remaining_credits=0,
+            timestamp=timestamp
+        )
+        for command_text in commands
+    ]
+
+@api_router.post("/commands/execute_batch", response_model=List[CommandExecutionResponse])
+async def execute_command_batch(
+    request: CommandBatchRequest,
+    user: UserPayload = Depends(get_current_user)
+):
+    """Execute several commands with one credit transaction; results keep request order"""
+    # Check if user has credits
+    if user.credits <= 0:
+        return _insufficient_batch(request.commands)
+    
+    # Process every command through the Orchestrator concurrently
+    results = await asyncio.gather(*(
+        CommandOrchestrator.process_command(command_text, user.id)
+        for command_text in request.commands
+    ))
+    
+    executed = sum(result["status"] == "EXECUTED" for result in results)
+    
+    # Deduct up to one credit per executed command in a single atomic
+    # statement; the locked read gives the balance the deduction was taken from
+    granted = 0
+    new_credits = user.credits
+    if executed > 0:
+        try:
+            row = await get_pool().fetchrow(
+                "WITH before AS (SELECT credits FROM app_users WHERE id = $2 FOR UPDATE) "
+                "UPDATE app_users SET credits = app_users.credits - LEAST(before.credits, $1) "
+                "FROM before WHERE app_users.id = $2 "
+                "RETURNING app_users.credits, before.credits - app_users.credits AS deducted",
+                executed, user.id
+            )
+        except Exception as e:
+            logger.error(f"Failed to update credits: {e}")
+            raise HTTPException(status_code=500, detail="Credit transaction failed")
+        
+        if row is None:
+            # User deleted since the auth check
+            invalidate_user(user.id)
+            return _insufficient_batch(request.commands)
+        
+        new_credits, granted = row['credits'], row['deducted']
+        # Keep the auth cache in step with the new balance
+        update_cached_credits(user, new_credits)
+    
+    total_used = granted
+    timestamp = datetime.utcnow().isoformat()
+    responses = []
+    log_rows = []
+    for command_text, result in zip(request.commands, results):
+        command_status = result["status"]
+        credits_used = 0
+        if command_status == "EXECUTED":
+            if granted > 0:
+                granted -= 1
+                credits_used = 1
+            else:
+                # Credits ran out part-way through the batch
+                responses.append(CommandExecutionResponse(
+                    status="INSUFFICIENT_CREDITS",
+                    command_text=command_text,
+                    verdict_source=result.get("layer"),
+                    risk_score=result.get("score", 0),
+                    reason="No credits available",
+                    matched_rule=result.get("matched_rule"),
+                    credits_used=0,
+                    remaining_credits=new_credits,
+                    timestamp=timestamp
+                ))
+                continue
+        
+        log_rows.append((
+            user.id,
+            command_text,
+            command_status,
+            result.get("layer"),
+            result.get("score", 0)
+        ))
+        responses.append(CommandExecutionResponse(
+            status=command_status,
+            command_text=command_text,
+            verdict_source=result.get("layer"),
+            risk_score=result.get("score", 0),
+            reason=result.get("reason"),
+            matched_rule=result.get("matched_rule"),
+            credits_used=credits_used,
+            remaining_credits=new_credits,
+            timestamp=timestamp
+        ))
+    
+    # One hand-off to the background writer for the whole batch
+    await log_commands(log_rows)
+    
+    logger.info(
+        f"User {user.id} executed a batch of {len(request.commands)} commands "
+        f"({executed} executed, {total_used} credits used)"
+    )
+    
+    return responses
+
 @api_router.get("/commands/history", response_model=List[CommandHistoryResponse])
 async def get_command_history(
     admin_view: bool = False,
@@ -460,37 +593,36 @@ async def get_command_history(
 ):
     """Get command execution history"""
     try:
-        # Fetch logs
-        query = supabase.table("command_logs").select("*")
-        
+        # Fetch logs with the user's name joined in (one round-trip)
         # If not admin or not requesting admin view, filter by user
-        if not (admin_view and user.role == 'admin'):
-            query = query.eq("user_id", user.id)
-            
-        response = query.order("created_at", desc=True).limit(100).execute()
-        logs = response.data
-        
-        # Manually fetch user names if needed
-        user_ids = list(set(log['user_id'] for log in logs if log.get('user_id')))
-        user_map = {}
-        
-        if user_ids:
-            users_res = supabase.table("app_users").select("id, name").in_("id", user_ids).execute()
-            for u in users_res.data:
-                user_map[u['id']] = u['name']
+        query = (
+            "SELECT c.id, c.user_id, c.command_text, c.status, c.verdict_source, c.risk_score, "
+            "c.created_at, u.name AS user_name "
+            "FROM command_logs c LEFT JOIN app_users u ON u.id = c.user_id "
+        )
+        if admin_view and user.role == 'admin':
+            rows = await get_pool().fetch(
+                query + "ORDER BY c.created_at DESC LIMIT 100"
+            )
+        else:
+            rows = await get_pool().fetch(
+                query + "WHERE c.user_id = $1 ORDER BY c.created_at DESC LIMIT 100",
+                user.id
+            )
+        logs = [record_to_dict(r) for r in rows]
         
         result = []
         for cmd in logs:
-            user_name = user_map.get(cmd.get('user_id'), 'Unknown')
+            user_name = cmd['user_name'] or 'Unknown'
             
-            result.append(CommandHistoryResponse(
+            result.append(CommandHistoryResponse.model_construct(
                 id=str(cmd['id']),
                 user_id=cmd['user_id'] or "",
                 user_name=user_name,
                 command_text=cmd['command_text'],
                 status=cmd['status'],
                 verdict_source=cmd.get('verdict_source'),
-                risk_score=cmd.get('risk_score', 0),
+                risk_score=cmd.get('risk_score') or 0,
                 timestamp=cmd['created_at']
             ))
         
@@ -502,10 +634,20 @@ async def get_command_history(
 # Include the router in the main app
 app.include_router(api_router)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    pass
-
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("server:app", host="0.0.0.0", port=8001, reload=True)
\ No newline at end of file
+    # Auto-reload is for local development only (and forces a single worker);
+    # "auto" picks uvloop/httptools when installed (uvicorn[standard]).
+    # One worker by default: the user/rule caches, the AI rate limit and the
+    # init_db seed are per process, so only raise WEB_CONCURRENCY knowingly.
+    dev = os.getenv("ENV") == "dev"
+    uvicorn.run(
+        "server:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", 8001)),
+        loop="auto",
+        http="auto",
+        workers=None if dev else int(os.getenv("WEB_CONCURRENCY", 1)),
+        reload=dev,
+        timeout_keep_alive=30,
+    )
\ No newline at end of file